@@ -18,7 +18,12 @@ from stimulation_example_official import (
     load_config,
     connect_stim_units_to_stim_electrodes,
     configure_and_powerup_stim_units,
+    create_pulse_commands,
     create_stim_pulse,
+    extend_sequence,
+    first_free_event_id,
+    mark_event_ids_used,
+    query_dac_lsb_mV,
     send_stim_pulses_all_units,
 )
 
@@ -34,6 +39,7 @@ def prepare_stim_sequence(
     changing_phase: Optional[bool] = False,
     max_phase: Optional[int] = None,
     phase_interval: Optional[int] = None,
+    first_event_id: Optional[int] = None,
 ) -> mx.Sequence:
     """Prepare a stimulation sequence.
 
@@ -68,6 +74,10 @@ def prepare_stim_sequence(
     phase_interval : Optional[int]
         Increment phase interval if changing_phase is True.
         Unit is sample (50us per sample).
+    first_event_id : Optional[int]
+        Event id of the first pulse, the following pulses are numbered
+        consecutively. By default, the numbering continues after the
+        last pulse of the previously built sequence.
     Returns
     -------
     mx.Sequence
@@ -75,56 +85,45 @@ def prepare_stim_sequence(
 
     """
     seq = mx.Sequence()
-    dac_lsb_mV = float(mx.query_DAC_lsb_mV())
-    if changing_amplitude and changing_phase:
+    event_id = first_free_event_id(first_event_id)
+    dac_lsb_mV = query_dac_lsb_mV()
+    # the inter-pulse delay and the pulse commands of one (amplitude, phase)
+    # combination are identical for every repetition, build them only once
+    inter_pulse_delay = mx.DelaySamples(inter_pulse_interval)
+    if changing_amplitude:
         if max_amplitude is None or amplitude_interval is None:
             raise ValueError(
                 "Both max_amplitude and amplitude_interval are required for changing_amplitude."
             )
+        amplitudes = range(amplitude, max_amplitude, amplitude_interval)
+    else:
+        amplitudes = [amplitude]
+    if changing_phase:
         if max_phase is None or phase_interval is None:
             raise ValueError(
                 "Both max_phase and phase_interval are required for changing_amplitude."
             )
-        for cur_amplitude in range(
-            amplitude, max_amplitude, amplitude_interval
-        ):
-            for cur_phase in range(phase, max_phase, phase_interval):
-                for _ in range(number_pulses_per_train):
-                    seq = create_stim_pulse(
-                        seq, int(cur_amplitude / dac_lsb_mV), cur_phase
-                    )
-                    seq.append(mx.DelaySamples(inter_pulse_interval))
-                seq.append(mx.DelaySamples(inter_pulse_interval))
-    elif changing_amplitude:
-        if max_amplitude is None or amplitude_interval is None:
-            raise ValueError(
-                "Both max_amplitude and amplitude_interval are required for changing_amplitude."
-            )
-        for cur_amplitude in range(
-            amplitude, max_amplitude, amplitude_interval
-        ):
-            for _ in range(number_pulses_per_train):
-                seq = create_stim_pulse(
-                    seq, int(cur_amplitude / dac_lsb_mV), phase
-                )
-                seq.append(mx.DelaySamples(inter_pulse_interval))
-            seq.append(mx.DelaySamples(inter_pulse_interval))
-    elif changing_phase:
-        if max_phase is None or phase_interval is None:
-            raise ValueError(
-                "Both max_phase and phase_interval are required for changing_amplitude."
-            )
-        for cur_phase in range(phase, max_phase, phase_interval):
+        phases = range(phase, max_phase, phase_interval)
+    else:
+        phases = [phase]
+    # convert every amplitude of the sweep to DAC bits once, before the loops
+    amp_codes = [
+        int(cur_amplitude / dac_lsb_mV) for cur_amplitude in amplitudes
+    ]
+    for amp_code in amp_codes:
+        for cur_phase in phases:
+            pulse = create_pulse_commands(amp_code, cur_phase)
             for _ in range(number_pulses_per_train):
-                seq = create_stim_pulse(
-                    seq, int(amplitude / dac_lsb_mV), cur_phase
+                extend_sequence(
+                    seq,
+                    create_stim_pulse(event_id, amp_code, cur_phase, pulse),
                 )
-                seq.append(mx.DelaySamples(inter_pulse_interval))
-            seq.append(mx.DelaySamples(inter_pulse_interval))
-    else:
-        for _ in range(number_pulses_per_train):
-            seq = create_stim_pulse(seq, int(amplitude / dac_lsb_mV), phase)
-            seq.append(mx.DelaySamples(inter_pulse_interval))
+                seq.append(inter_pulse_delay)
+                event_id += 1
+            if changing_amplitude or changing_phase:
+                # separate the pulse trains of two parameter combinations
+                seq.append(inter_pulse_delay)
+    mark_event_ids_used(event_id)
     return seq
 
 
@@ -137,7 +136,6 @@ if __name__ == "__main__":
         3580,
         4887,
     ]  # <-- modify based on your stimulation electrodes selection
-    event_counter = 1  # variable to keep track of the event_id
     array = load_config(config_path)
     stim_units = connect_stim_units_to_stim_electrodes(stim_electrodes, array)
     wells = list(range(1))
@@ -150,6 +148,10 @@ if __name__ == "__main__":
     time.sleep(
         15
     )  # <-- set a larger delay here if more time required for recording in the software
+    # The stimulation sequence is not built in a background thread during
+    # the waits above: its events have to be added after mx.clear_events()
+    # and after the recording has started (see below), and building it also
+    # queries the DAC resolution from the server.
     mx.clear_events()  # Empty event-buffer before adding anything to it
 
     stim_unit_commands = configure_and_powerup_stim_units(stim_units)
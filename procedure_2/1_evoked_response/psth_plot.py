@@ -16,18 +16,13 @@ import matplotlib.pyplot as plt
 from spykes.plot.neurovis import NeuroVis
 from spykes.plot.popvis import PopVis
 
-## read spike and stimulation timing files ##
+## read stimulation timing file ##
 path = ""
 filename = "fig3a_psth_exp"
-spike_time = pd.read_csv(
-    path + filename + "_spike.csv", dtype=object, usecols=[1, 2, 3]
-)
-spike_time = spike_time.astype({"time": "float"})
-#
 filename_stim = filename + "_sti_time"
-sti_time = pd.read_csv(path + filename_stim + ".csv", dtype=float, header=None)
-sti_time = sti_time.values.tolist()
-sti_time = np.concatenate(sti_time)
+sti_time = np.loadtxt(
+    path + filename_stim + ".csv", delimiter=",", dtype=np.float64
+).ravel()
 
 ## hyper parameters ##
 top_n = 16  # top N active electrode to be selected
@@ -38,34 +33,71 @@ sti_amp = np.arange(100, amp_max + amp_init, amp_init)  # list of all stim amps
 sti_dura = [100, 200, 300, 400, 500]  # list of all stimulation durations
 durations = np.size(sti_dura)  # number of durations
 amplitudes = np.size(sti_amp)  # number of amplitudes
+# dura0 [7amp * 5rep] dura1 [..] dura2 [..] dura3 [..] dura4 [..]
+sti_cube = sti_time.reshape(durations, amplitudes, repetitions_per_pulse)
+chunk_size = 10**6  # number of spikes read at once from the spike file
+
+
+## read spike timing file and filter out stimulation artifacts happening between [-2ms,+2ms] of each stimulation time point ##
+def remove_stim_artifacts(spikes, sti_sorted, artifact=0.002):
+    """drop the spikes within artifact (s) of their nearest stimulation time."""
+    # find the nearest stimulation time of every spike with a single searchsorted
+    # on the sorted stimulation times instead of looping over all stimulations
+    t = spikes["time"].to_numpy()
+    idx = np.searchsorted(sti_sorted, t)
+    left = sti_sorted[np.clip(idx - 1, 0, len(sti_sorted) - 1)]
+    right = sti_sorted[np.clip(idx, 0, len(sti_sorted) - 1)]
+    dist = np.minimum(np.abs(t - left), np.abs(t - right))
+    return spikes.loc[dist > artifact]
 
-## filter out stimulation artifacts happening between [-2ms,+2ms] of each stimulation time point ##
-for sti_t in sti_time:
-    spike_time = spike_time[
-        (spike_time["time"] < sti_t - 0.002)
-        | (spike_time["time"] > sti_t + 0.002)
+
+# the spike file is filtered chunk by chunk, so only the spikes kept by the
+# filter are held in memory together
+sti_sorted = np.sort(sti_time)
+spike_chunks = pd.read_csv(
+    path + filename + "_spike.csv",
+    usecols=["time", "channel", "amplitude"],
+    dtype={"time": np.float64, "channel": "category", "amplitude": np.float32},
+    chunksize=chunk_size,
+)
+spike_time = pd.concat(
+    [remove_stim_artifacts(chunk, sti_sorted) for chunk in spike_chunks]
+)
+# each chunk has its own channel categories, categorize the joined column again
+spike_time = spike_time.astype({"channel": "category"})
+## keep only the spikes of the top_n most active electrodes ##
+# count the spikes per channel on the integer category codes, select the
+# top_n channels with a partial sort and mask their rows on the same codes.
+# Channels whose spikes were all filtered out are never selected, and files
+# with fewer than top_n active channels keep all of them.
+codes = spike_time["channel"].cat.codes.to_numpy()
+categories = spike_time["channel"].cat.categories
+counts = np.bincount(codes, minlength=len(categories))
+active_codes = np.flatnonzero(counts)
+kth = min(top_n, len(active_codes)) - 1
+if kth < 0:
+    top_codes = active_codes
+else:
+    top_codes = active_codes[
+        np.argpartition(-counts[active_codes], kth)[: kth + 1]
     ]
-ch_0 = spike_time["channel"].value_counts()[:top_n].index.tolist()
-spike_time = spike_time.astype({"time": "string"})
-spike_time_filtered = spike_time[
-    spike_time[["channel", "time"]]
-    .apply(lambda x: x.str.contains("|".join(ch_0)))
-    .any(axis=1)
-]
-spike_time_filtered = spike_time_filtered.astype({"time": "float"})
-spike_time_filtered = spike_time_filtered.astype({"amplitude": "float"})
-## re-organize spike information as a list per active electrode (channel) ##
-spike_time_filtered_per_channel = spike_time_filtered.groupby(
-    "channel", as_index=False
-).agg(lambda x: x.tolist())
+spike_time_filtered = spike_time.iloc[np.isin(codes, top_codes)]
+## re-organize spike information as an array per active electrode (channel) ##
+# sort by channel once and split the time column at the channel boundaries
+spike_time_sorted = spike_time_filtered.sort_values("channel", kind="stable")
+channels = spike_time_sorted["channel"].to_numpy()
+_, channel_starts = np.unique(channels, return_index=True)
+spike_time_filtered_per_channel = np.split(
+    spike_time_sorted["time"].to_numpy(), channel_starts[1:]
+)
 
 
 ## initiate spykes NeuroVis and PopVis object with spike_time_filtered_per_channel ##
 def initiate_neurons(raw_data):
     neuron_list = list()
 
-    for i in range((raw_data["time"]).shape[0]):
-        spike_times = raw_data["time"][i]
+    for i in range(len(raw_data)):
+        spike_times = raw_data[i]
 
         # instantiate neuron
         neuron = NeuroVis(spike_times, name="Electrode %d" % (i + 1))
@@ -79,7 +111,75 @@ neuron_list = initiate_neurons(spike_time_filtered_per_channel)[
 ]  # <-- change top_n value if more or less electrodes are needed.
 pop = PopVis(neuron_list)
 
-## construct stimulation dataframe to select stimulation timing information for ploting ##
+
+## bin spikes around every stimulation with np.bincount instead of the spykes event loop ##
+def fast_psth(spikes, events, window, binsize):
+    """spike counts of sorted spikes (s) around each event (s), shape (n_events, n_bins).
+
+    window and binsize are in ms, window must be a multiple of binsize.
+    """
+    n_bins = int(round((window[1] - window[0]) / binsize))
+    lo = np.searchsorted(spikes, events + 1e-3 * window[0])
+    hi = np.searchsorted(spikes, events + 1e-3 * window[1])
+    n_spikes = hi - lo
+    # event index and spike index of every spike falling in an event window
+    event_idx = np.repeat(np.arange(len(events)), n_spikes)
+    spike_idx = (
+        np.arange(n_spikes.sum())
+        - np.repeat(np.cumsum(n_spikes) - n_spikes, n_spikes)
+        + np.repeat(lo, n_spikes)
+    )
+    # estimate the bin arithmetically, then correct it against the bin edges
+    # so that spikes sitting on an edge are counted like np.histogram does
+    edges = events[:, None] + 1e-3 * np.arange(
+        window[0], window[1] + binsize, binsize
+    )
+    t = spikes[spike_idx]
+    rel = t - events[event_idx] - 1e-3 * window[0]
+    bin_idx = np.clip((rel / (1e-3 * binsize)).astype(np.int64), 0, n_bins - 1)
+    bin_idx -= t < edges[event_idx, bin_idx]
+    bin_idx += (t >= edges[event_idx, bin_idx + 1]) & (bin_idx < n_bins - 1)
+    counts = np.bincount(
+        event_idx * n_bins + bin_idx, minlength=len(events) * n_bins
+    )
+    return counts.reshape(len(events), n_bins)
+
+
+def get_all_psth(neuron_list, event, df, conditions, window, binsize):
+    """same output as PopVis.get_all_psth (mean firing rate per neuron and condition)."""
+    # spykes extends the window to whole bins before binning the spikes
+    bin_window = [
+        np.floor(window[0] / binsize) * binsize,
+        np.ceil(window[1] / binsize) * binsize,
+    ]
+    events = df[event].to_numpy()
+    labels = df[conditions].to_numpy()
+    all_psth = {
+        "window": window,
+        "binsize": binsize,
+        "event": event,
+        "conditions": conditions,
+        "data": {},
+    }
+    cond_ids, event_cond = np.unique(labels, return_inverse=True)
+    # bin every electrode once over all events, then sum the events of each
+    # condition into a (neuron, condition, bin) accumulator
+    counts = np.stack(
+        [
+            fast_psth(neuron.spiketimes, events, bin_window, binsize)
+            for neuron in neuron_list
+        ]
+    )
+    sums = np.zeros((counts.shape[0], len(cond_ids), counts.shape[2]))
+    np.add.at(sums, (slice(None), event_cond), counts)
+    rates = sums / np.bincount(event_cond)[:, None] / (1e-3 * binsize)
+    for i, cond_id in enumerate(cond_ids):
+        all_psth["data"][cond_id] = rates[:, i]
+    return all_psth
+
+
+## construct stimulation dataframe with the stimulation timing of every condition ##
+# all (duration, amplitude) conditions are binned in a single get_all_psth call,
 # here choose 500mV amplitude and 500us phase duration to display
 event = "stiTime"
 condition = "Sequence"
@@ -90,54 +190,47 @@ dura_num = 4
 dura = sti_dura[dura_num]  # 500us
 amp_plot = [4]  # fourth amp, that is 500mV
 
-seq_type = []
-sti_type = str(dura) + "us " + str(sti_amp[amp_plot[0]]) + "mVpp"
+# condition labels laid out like sti_cube, (duration, amplitude)
+sti_labels = np.asarray(
+    [str(d) + "us " + str(a) + "mVpp" for d in sti_dura for a in sti_amp]
+).reshape(durations, amplitudes)
+sti_type = sti_labels[dura_num, amp_plot[0]]
 print(sti_type)
-sti_type = np.repeat(sti_type, repetitions_per_pulse)
-seq_type.append(sti_type)
-seq_type = np.concatenate(seq_type)
-
-sti_time_plot = []
-for i in amp_plot:
-    # dura0 [5rep * 7amp] dura1 [..] dura2 [..] dura3 [..] dura4 [..]
-    sti_t = sti_time[
-        (dura_num * repetitions_per_pulse * amplitudes)
-        + repetitions_per_pulse * i : (dura_num)
-        * repetitions_per_pulse
-        * amplitudes
-        + repetitions_per_pulse * i
-        + repetitions_per_pulse
-    ]
-    sti_time_plot.append(sti_t)
 
-stimulation_df["stiTime"] = np.concatenate(sti_time_plot)
-stimulation_df["Sequence"] = seq_type
+stimulation_df["stiTime"] = sti_cube.ravel()
+stimulation_df["Sequence"] = np.repeat(
+    sti_labels.ravel(), repetitions_per_pulse
+)
 
-## plot and save the raster plot and PSTH ##
-fig = plt.figure(figsize=(10, 5))
-fig.subplots_adjust(hspace=0.3)
-all_psth = pop.get_all_psth(
+all_psth = get_all_psth(
+    neuron_list,
     event=event,
     df=stimulation_df,
     conditions=condition,
     window=window,
     binsize=binsize,
-    plot=True,
-    colors=["RdYlBu_r"],
 )
+# the population PSTH normalises each electrode across all conditions it is
+# given, so only pass on the displayed condition
+plot_psth = dict(all_psth, data={sti_type: all_psth["data"][sti_type]})
+
+## plot and save the raster plot and PSTH ##
+fig = plt.figure(figsize=(10, 5))
+fig.subplots_adjust(hspace=0.3)
+pop.plot_heat_map(plot_psth, colors=["RdYlBu_r"])
 plt.clim(0, 45)
 plt.savefig(
     path
     + filename
     + "_"
-    + str(seq_type[1])
+    + sti_type
     + "us_32_"
     + str(binsize)
     + "ms"
     + "_raster.svg"
 )
 
-df_raster = pd.DataFrame(all_psth["data"]["500us 500mVpp"])
+df_raster = pd.DataFrame(plot_psth["data"][sti_type])
 df_raster.to_csv(
     path
     + filename
@@ -151,7 +244,7 @@ df_raster.to_csv(
 )
 
 plt.figure(figsize=(10, 5))
-pop.plot_population_psth(all_psth=all_psth)
+pop.plot_population_psth(all_psth=plot_psth)
 plt.ylim(0, 0.6)
 plt.savefig(
     path
@@ -17,7 +17,7 @@
 #                 sti_dura = [100,200,300,400,500] us  (5 durations)
 #              giving 5 x 7 x 5 = 175 stimulation events, ordered with duration as the
 #              outermost loop, amplitude in the middle and the 5 repetitions innermost
-#              (see psth_plot.py lines 100-110).
+#              (see sti_cube in psth_plot.py).
 # -------------------------------------------------------------
 
 import os
@@ -39,10 +39,9 @@ spike_time = pd.read_csv(
 )
 spike_time = spike_time.astype({"time": "float"})
 
-sti_time = pd.read_csv(
-    os.path.join(path, filename + "_sti_time.csv"), dtype=float, header=None
-)
-sti_time = np.concatenate(sti_time.values.tolist())
+sti_time = np.loadtxt(
+    os.path.join(path, filename + "_sti_time.csv"), delimiter=",", dtype=np.float64
+).ravel()
 
 ## ------------------------------------------------------------------ ##
 ## hyper parameters (stimulation protocol, identical to psth_plot.py)
@@ -84,7 +83,8 @@ for sti_t in sti_time:
         | (spike_time["time"] > sti_t + artifact)
     ]
 
-ch_top = spike_time["channel"].value_counts()[:top_n].index.tolist()
+# nlargest selects the top_n channels with a heap instead of sorting all counts
+ch_top = spike_time["channel"].value_counts(sort=False).nlargest(top_n).index.tolist()
 spike_time = spike_time[spike_time["channel"].isin(ch_top)]
 
 # sorted spike-time array -> fast spike counting with np.searchsorted
@@ -14,13 +14,19 @@
 import os
 import time
 import maxlab as mx
+from typing import Optional
 
 from stimulation_example_official import (
     initialize_system,
     configure_array,
     connect_stim_units_to_stim_electrodes,
     configure_and_powerup_stim_units,
+    create_pulse_commands,
     create_stim_pulse,
+    extend_sequence,
+    first_free_event_id,
+    mark_event_ids_used,
+    query_dac_lsb_mV,
     send_stim_pulses_all_units,
 )
 
@@ -31,17 +37,29 @@ def prepare_stim_sequence(
     inter_train_interval: int,
     phase: int,
     amplitude: int,
+    first_event_id: Optional[int] = None,
 ) -> mx.Sequence:
     seq = mx.Sequence()
-    dac_lsb_mV = float(mx.query_DAC_lsb_mV())
+    event_id = first_free_event_id(first_event_id)
+    dac_lsb_mV = query_dac_lsb_mV()
+    # every pulse has the same amplitude and phase, build its commands once
+    amp_code = int(amplitude / dac_lsb_mV)
+    pulse = create_pulse_commands(amp_code, phase)
+    inter_pulse_delay = mx.DelaySamples(inter_pulse_interval)
+    # wait twice the inter-train interval between two trains, with a single
+    # delay command
+    inter_train_delay = mx.DelaySamples(2 * inter_train_interval)
     repeating_number = 1
     for _ in range(number_pulses_per_train):
         for rep in range(repeating_number):
-            seq = create_stim_pulse(seq, int(amplitude / dac_lsb_mV), phase)
-            seq.append(mx.DelaySamples(inter_pulse_interval))
+            extend_sequence(
+                seq, create_stim_pulse(event_id, amp_code, phase, pulse)
+            )
+            seq.append(inter_pulse_delay)
+            event_id += 1
         repeating_number += 1
-        seq.append(mx.DelaySamples(inter_train_interval))
-        seq.append(mx.DelaySamples(inter_train_interval))
+        seq.append(inter_train_delay)
+    mark_event_ids_used(event_id)
     return seq
 
 
@@ -83,7 +101,6 @@ if __name__ == "__main__":
         3361,
     ]
     stim_electrodes = [3580, 4887]
-    event_counter = 1  # variable to keep track of the event_id
     array = configure_array(electrodes, stim_electrodes)
     stim_units = connect_stim_units_to_stim_electrodes(stim_electrodes, array)
     wells = list(range(1))
@@ -94,6 +111,10 @@ if __name__ == "__main__":
     mx.offset()
     # Wait a few more seconds to make sure the offset compensation is done
     time.sleep(15)
+    # The stimulation sequence is not built in a background thread during
+    # the waits above: its events have to be added after mx.clear_events()
+    # and after the recording has started (see below), and building it also
+    # queries the DAC resolution from the server.
     mx.clear_events()  # Empty event-buffer before adding anything to it
 
     stim_unit_commands = configure_and_powerup_stim_units(stim_units)
@@ -67,9 +67,12 @@ array.load_config(name_of_configuration)
 
 stimulation_units = []
 
+# bind the array methods once instead of looking them up for every electrode
+connect_electrode = array.connect_electrode_to_stimulation
+query_stimulation = array.query_stimulation_at_electrode
 for stim_el in sti_electrodes:
-    array.connect_electrode_to_stimulation(stim_el)
-    stim = array.query_stimulation_at_electrode(stim_el)
+    connect_electrode(stim_el)
+    stim = query_stimulation(stim_el)
     if stim:
         stimulation_units.append(stim)
     else:
@@ -84,48 +87,57 @@ array.download()
 # Prepare commands to power up and power down the two stimulation units
 
 
-def cmd_power_pattern(seq, pattern, stimulation_units):
-    for num in pattern:
-        sti_power = (
-            maxlab.chip.StimulationUnit(stimulation_units[num])
-            .power_up(True)
-            .connect(True)
-            .set_voltage_mode()
-            .dac_source(0)
-        )
-        seq.append(sti_power)
+def cmd_power_pattern(pattern, stimulation_units):
+    return [
+        maxlab.chip.StimulationUnit(stimulation_units[num])
+        .power_up(True)
+        .connect(True)
+        .set_voltage_mode()
+        .dac_source(0)
+        for num in pattern
+    ]
 
 
-def cmd_power_down_pattern(seq, pattern, stimulation_units):
-    for num in pattern:
-        sti_power_down = maxlab.chip.StimulationUnit(
-            stimulation_units[num]
-        ).power_up(False)
-        seq.append(sti_power_down)
+def cmd_power_down_pattern(pattern, stimulation_units):
+    return [
+        maxlab.chip.StimulationUnit(stimulation_units[num]).power_up(False)
+        for num in pattern
+    ]
 
 
 ## 3. Prepare pulse trains of different patterns
 
 
-def append_stimulation_pulse(seq, amplitude):
-    seq.append(maxlab.chip.DAC(0, 512 - amplitude))
-    seq.append(maxlab.system.DelaySamples(4))
-    seq.append(maxlab.chip.DAC(0, 512 + amplitude))
-    seq.append(maxlab.system.DelaySamples(4))
-    seq.append(maxlab.chip.DAC(0, 512))
+def stimulation_pulse(amplitude):
+    return [
+        maxlab.chip.DAC(0, 512 - amplitude),
+        maxlab.system.DelaySamples(4),
+        maxlab.chip.DAC(0, 512 + amplitude),
+        maxlab.system.DelaySamples(4),
+        maxlab.chip.DAC(0, 512),
+    ]
+
+
+def extend_sequence(seq, commands):
+    for command in commands:
+        seq.append(command)
     return seq
 
 
 amplitude = 150
+# The pulse (followed by a 5 s wait between two pulses) and the power up/down
+# commands of a pattern are the same for every repetition: build them once
+pulse_ops = stimulation_pulse(amplitude) + [
+    maxlab.system.DelaySamples(20000) for _ in range(5)
+]
 sequence1 = maxlab.Sequence()
 for pattern in patterns:
+    power_ops = cmd_power_pattern(pattern, stimulation_units)
+    power_down_ops = cmd_power_down_pattern(pattern, stimulation_units)
     for rep in range(0, 30):
-        cmd_power_pattern(sequence1, pattern, stimulation_units)
-        append_stimulation_pulse(sequence1, amplitude)
-        # Wait 5 s between two pulses
-        for _ in range(5):
-            sequence1.append(maxlab.system.DelaySamples(20000))
-        cmd_power_down_pattern(sequence1, pattern, stimulation_units)
+        extend_sequence(sequence1, power_ops)
+        extend_sequence(sequence1, pulse_ops)
+        extend_sequence(sequence1, power_down_ops)
 
 # 4. Start recording, deliver pulse trains of all patterns, and stop recording
 
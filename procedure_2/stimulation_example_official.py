@@ -12,11 +12,13 @@ Warning: No recordings are made in this example, but you can find
 an example about how to record in another script, called `recordings.py`.
 """
 
+import hashlib
+import os
 import time
 
 import maxlab as mx
 
-from typing import List, Optional
+from typing import List, Optional, Set
 from pathlib import Path
 
 # fmt: off
@@ -27,7 +29,16 @@ electrodes = [4885, 4666, 4886, 4022, 5327, 5328, 5106, 5326, 3138, 3140, 2919,
               3360, 3802, 3358, 3578, 2920, 4019, 3582, 3362, 3577, 4887, 3139,
               3800, 3579, 3581,]
 # fmt: on
-event_counter = 1  # variable to keep track of the event_id
+_dac_lsb_mV: Optional[float] = None  # DAC resolution, queried only once
+_next_event_id = 2  # event id of the next pulse, shared by all sequences
+# routed configurations are cached here, set MAXLAB_NO_ROUTE_CACHE=1 to
+# always route again
+route_cache_dir = Path("~/.cache/maxlab_routes").expanduser()
+# array geometry, used to check the stimulation electrodes offline
+n_stim_units = 32  # number of stimulation units on the chip
+n_electrodes = 26400  # 220 columns x 120 rows
+electrode_columns = 220
+electrode_pitch_um = 17.5
 
 
 def initialize_system() -> None:
@@ -79,13 +90,31 @@ def configure_array(
     function `connect_stim_units_to_stim_electrodes`. This is the reason
     why `array.download` is not part of this function.
 
+    Routing is the slowest step, so the routed configuration is saved in
+    `route_cache_dir` under a hash of the selected electrodes. The next
+    time the same electrodes are selected, the configuration is loaded
+    from there instead of being routed again. Set the environment
+    variable `MAXLAB_NO_ROUTE_CACHE=1` to always route.
+
     """
+    use_cache = not os.environ.get("MAXLAB_NO_ROUTE_CACHE")
+    key = hashlib.sha1(
+        repr((sorted(electrodes), sorted(stim_electrodes))).encode()
+    ).hexdigest()
+    cache_path = route_cache_dir / f"{key}.cfg"
+    if use_cache and cache_path.is_file():
+        array = load_config(str(cache_path))
+        array.select_stimulation_electrodes(stim_electrodes)
+        return array
     array = mx.Array("stimulation")
     array.reset()
     array.clear_selected_electrodes()
     array.select_electrodes(electrodes)
     array.select_stimulation_electrodes(stim_electrodes)
     array.route()
+    if use_cache:
+        route_cache_dir.mkdir(parents=True, exist_ok=True)
+        array.save_config(str(cache_path))
     return array
 
 
@@ -125,6 +154,64 @@ def load_config(config_file: str) -> mx.Array:
     return array
 
 
+def validate_stim_electrodes(
+    stim_electrodes: List[int], min_distance_um: Optional[float] = None
+) -> None:
+    """Check the stimulation electrodes before connecting them
+
+    The number of stimulation electrodes, duplicates and the electrode
+    indices can be checked without the server, so a wrong selection is
+    reported before any electrode is connected. Which stimulation unit an
+    electrode is connected to is only known after routing, so two
+    electrodes sharing a unit are still detected in
+    `connect_stim_units_to_stim_electrodes`.
+
+    Parameters
+    ----------
+    stim_electrodes : List[int]
+        List of the index of the stimulation electrodes
+    min_distance_um : Optional[float]
+        Minimal distance between two stimulation electrodes in um. By
+        default, the distance is not checked.
+
+    Raises
+    ------
+    ValueError
+        If more than 32 stimulation electrodes are selected.
+        If an electrode index is out of range or selected twice.
+        If two electrodes are closer than min_distance_um.
+
+    """
+    if len(stim_electrodes) > n_stim_units:
+        raise ValueError(
+            f"{len(stim_electrodes)} stimulation electrodes selected, at most {n_stim_units} are allowed."
+        )
+    seen_electrodes: Set[int] = set()
+    for stim_el in stim_electrodes:
+        if not 0 <= stim_el < n_electrodes:
+            raise ValueError(f"Electrode {stim_el} does not exist.")
+        if stim_el in seen_electrodes:
+            raise ValueError(f"Electrode {stim_el} is selected twice.")
+        seen_electrodes.add(stim_el)
+    if min_distance_um is None:
+        return
+    positions = [
+        (
+            (stim_el % electrode_columns) * electrode_pitch_um,
+            (stim_el // electrode_columns) * electrode_pitch_um,
+        )
+        for stim_el in stim_electrodes
+    ]
+    for i in range(len(positions)):
+        for j in range(i + 1, len(positions)):
+            dx = positions[i][0] - positions[j][0]
+            dy = positions[i][1] - positions[j][1]
+            if (dx * dx + dy * dy) ** 0.5 < min_distance_um:
+                raise ValueError(
+                    f"Electrodes {stim_electrodes[i]} and {stim_electrodes[j]} are closer than {min_distance_um} um."
+                )
+
+
 def connect_stim_units_to_stim_electrodes(
     stim_electrodes: List[int], array: mx.Array
 ) -> List[int]:
@@ -158,11 +245,16 @@ def connect_stim_units_to_stim_electrodes(
 
     Raises
     ------
+    ValueError
+        If the stimulation electrodes do not pass
+        `validate_stim_electrodes`.
     RuntimeError
         If an electrode cannot be connected to a stimulation unit.
         If two electrodes are connected to the same stimulation unit.
     """
+    validate_stim_electrodes(stim_electrodes)
     stim_units: List[int] = []
+    seen_units: Set[int] = set()
     for stim_el in stim_electrodes:
         array.connect_electrode_to_stimulation(stim_el)
         stim = array.query_stimulation_at_electrode(stim_el)
@@ -171,12 +263,13 @@ def connect_stim_units_to_stim_electrodes(
                 f"No stimulation channel can connect to electrode: {str(stim_el)}"
             )
         stim_unit_int = int(stim)
-        if stim_unit_int in stim_units:
+        if stim_unit_int in seen_units:
             raise RuntimeError(
                 f"Two electrodes connected to the same stim unit.\
                                This is not allowed. Please Select a neighboring electrode of {stim_el}!"
             )
         else:
+            seen_units.add(stim_unit_int)
             stim_units.append(stim_unit_int)
     return stim_units
 
@@ -246,21 +339,116 @@ def poweroff_all_stim_units() -> None:
     powered-off before starting sequentially to send the sequences to the
     different stimulation units individually.
 
+    The 32 power-off commands are collected in one sequence and sent
+    together, instead of sending every unit's command separately.
+
     Returns
     -------
     None
 
     """
+    seq = mx.Sequence()
     for stimulation_unit in range(0, 32):
-        stim = mx.StimulationUnit(stimulation_unit)
-        stim.power_up(False)
-        stim.connect(False)
-        mx.send(stim)
+        seq.append(
+            mx.StimulationUnit(stimulation_unit).power_up(False).connect(False)
+        )
+    seq.send()
+
+
+def query_dac_lsb_mV() -> float:
+    """Query the DAC resolution
+
+    The resolution of the DAC channels (how many millivolts one bit
+    corresponds to) is needed to convert the pulse amplitudes to DAC
+    bits. It does not change while the system is running, so it is
+    only queried from the server the first time and cached afterwards.
+
+    Returns
+    -------
+    float
+        The DAC resolution in millivolt per bit.
+
+    """
+    global _dac_lsb_mV
+    if _dac_lsb_mV is None:
+        _dac_lsb_mV = float(mx.query_DAC_lsb_mV())
+    return _dac_lsb_mV
+
+
+def first_free_event_id(first_event_id: Optional[int] = None) -> int:
+    """Get the event id of the first pulse of a new sequence
+
+    Sequences built one after the other in the same session continue
+    numbering their pulses where the previous sequence stopped, so that
+    the event ids in one recording stay unique.
+
+    Parameters
+    ----------
+    first_event_id : Optional[int]
+        Event id requested by the caller. If None, the next event id that
+        has not been used yet is returned.
+
+    Returns
+    -------
+    int
+        The event id of the first pulse.
+
+    """
+    return _next_event_id if first_event_id is None else first_event_id
+
+
+def mark_event_ids_used(next_event_id: int) -> None:
+    """Mark the event ids below `next_event_id` as used
+
+    Parameters
+    ----------
+    next_event_id : int
+        Event id following the last pulse of the sequence just built.
+
+    Returns
+    -------
+    None
+
+    """
+    global _next_event_id
+    _next_event_id = max(_next_event_id, next_event_id)
+
+
+def create_pulse_commands(amplitude: int, delay_samples: int) -> list:
+    """Create the DAC commands of one biphasic pulse
+
+    The commands only depend on the amplitude and the phase of the
+    pulse, so they can be built once and appended again for every
+    repetition of the same pulse (see `create_stim_pulse`).
+
+    Parameters
+    ----------
+    amplitude : int
+        Amplitude of the pulse, with units [100mV/2.9].
+    delay_samples : int
+        How many samples should sand between different sequence amplitude.
+
+    Returns
+    -------
+    list
+        The DAC and delay commands making up the pulse.
+
+    """
+    return [
+        mx.DAC(0, 512 - amplitude),
+        mx.DelaySamples(delay_samples),
+        mx.DAC(0, 512 + amplitude),
+        mx.DelaySamples(delay_samples),
+        mx.DAC(0, 512),
+    ]
 
 
 def create_stim_pulse(
-    seq: mx.Sequence, amplitude: int, delay_samples: int
-) -> mx.Sequence:
+    event_id: int,
+    amplitude: int,
+    delay_samples: int,
+    pulse_commands: Optional[list] = None,
+) -> list:
     """Create stimulation pulse
 
     The stimulation units can be controlled through three independent
@@ -281,37 +469,56 @@ def create_stim_pulse(
     on DAC channel 0, all the stimulation units exhibit the biphasic
     pulse.
 
+    The event id is passed in by the caller instead of being counted
+    in a module variable, so the function only returns the commands of
+    the pulse and does not change any state. Use `extend_sequence` to
+    append them to a sequence.
+
     Parameters
     ----------
-    seq : mx.Sequence
-        Sequence object holding a sequence of commands, as generated
-        by `mx.Sequence()`.
+    event_id : int
+        Id of the event marking the pulse in the recording.
     amplitude : int
         Amplitude of the pulse, with units [100mV/2.9], as explained above.
     delay_samples : int
         How many samples should sand between different sequence amplitude.
+    pulse_commands : Optional[list]
+        Pulse commands previously built by `create_pulse_commands` for
+        the same amplitude and delay_samples. If None, they are created.
+
+    Returns
+    -------
+    list
+        The event command followed by the pulse commands.
+
+    """
+    if pulse_commands is None:
+        pulse_commands = create_pulse_commands(amplitude, delay_samples)
+    return [
+        mx.Event(0, 1, event_id, f"amplitude {amplitude} event_id {event_id}")
+    ] + pulse_commands
+
+
+def extend_sequence(seq: mx.Sequence, commands: list) -> mx.Sequence:
+    """Append a list of commands to a sequence
+
+    Parameters
+    ----------
+    seq : mx.Sequence
+        Sequence object holding a sequence of commands, as generated
+        by `mx.Sequence()`.
+    commands : list
+        The commands to append, in order.
 
     Returns
     -------
     mx.Sequence
-        Sequence object filled by the pulse.
+        The same sequence object, with the commands appended.
 
     """
-    global event_counter
-    event_counter += 1
-    seq.append(
-        mx.Event(
-            0,
-            1,
-            event_counter,
-            f"amplitude {amplitude} event_id {event_counter}",
-        )
-    )
-    seq.append(mx.DAC(0, 512 - amplitude))
-    seq.append(mx.DelaySamples(delay_samples))
-    seq.append(mx.DAC(0, 512 + amplitude))
-    seq.append(mx.DelaySamples(delay_samples))
-    seq.append(mx.DAC(0, 512))
+    append = seq.append
+    for command in commands:
+        append(command)
     return seq
 
 
@@ -323,6 +530,7 @@ def prepare_stim_sequence(
     changing_amplitude: Optional[bool] = False,
     max_amplitude: Optional[int] = None,
     amplitude_interval: Optional[int] = None,
+    first_event_id: Optional[int] = None,
 ) -> mx.Sequence:
     """Prepare a stimulation sequence.
 
@@ -349,6 +557,10 @@ def prepare_stim_sequence(
     amplitude_interval : Optional[int]
         Increment amplitude interval if changing_amplitude is True.
         Unit is millivolt.
+    first_event_id : Optional[int]
+        Event id of the first pulse, the following pulses are numbered
+        consecutively. By default, the numbering continues after the
+        last pulse of the previously built sequence (2 for the first one).
 
     Returns
     -------
@@ -357,25 +569,42 @@ def prepare_stim_sequence(
 
     """
     seq = mx.Sequence()
-    dac_lsb_mV = float(mx.query_DAC_lsb_mV())
+    event_id = first_free_event_id(first_event_id)
+    dac_lsb_mV = query_dac_lsb_mV()
+    # the inter-pulse delay and the pulse commands of one amplitude are
+    # identical for every repetition, build them only once
+    inter_pulse_delay = mx.DelaySamples(inter_pulse_interval)
     if changing_amplitude:
         if max_amplitude is None or amplitude_interval is None:
             raise ValueError(
                 "Both max_amplitude and amplitude_interval are required for changing_amplitude."
             )
-        for cur_amplitude in range(
-            amplitude, max_amplitude, amplitude_interval
-        ):
+        # convert every amplitude of the sweep to DAC bits before the loops
+        amp_bits_list = [
+            int(cur_amplitude / dac_lsb_mV)
+            for cur_amplitude in range(
+                amplitude, max_amplitude, amplitude_interval
+            )
+        ]
+        for amp_bits in amp_bits_list:
+            pulse = create_pulse_commands(amp_bits, phase)
             for _ in range(number_pulses_per_train):
-                seq = create_stim_pulse(
-                    seq, int(cur_amplitude / dac_lsb_mV), phase
+                extend_sequence(
+                    seq, create_stim_pulse(event_id, amp_bits, phase, pulse)
                 )
-                seq.append(mx.DelaySamples(inter_pulse_interval))
-            seq.append(mx.DelaySamples(inter_pulse_interval))
+                seq.append(inter_pulse_delay)
+                event_id += 1
+            seq.append(inter_pulse_delay)
     else:
+        amp_bits = int(amplitude / dac_lsb_mV)
+        pulse = create_pulse_commands(amp_bits, phase)
         for _ in range(number_pulses_per_train):
-            seq = create_stim_pulse(seq, int(amplitude / dac_lsb_mV), phase)
-            seq.append(mx.DelaySamples(inter_pulse_interval))
+            extend_sequence(
+                seq, create_stim_pulse(event_id, amp_bits, phase, pulse)
+            )
+            seq.append(inter_pulse_delay)
+            event_id += 1
+    mark_event_ids_used(event_id)
     return seq
 
 
@@ -388,6 +617,14 @@ def send_stim_pulses_all_units(
     function `prepare_stim_sequence` (the pulse train) for the
     case where the stimulation pulses are sent simultaneously to all units.
 
+    Notes
+    -----
+    The pulse trains are started every 10 seconds. The wait is measured
+    with `time.monotonic()` from the start of each train, so the time
+    spent sending does not add up over the trains. The next sequence is
+    not built during the wait, since the events of a sequence have to be
+    added after the recording has started (see the `__main__` block).
+
     Parameters
     ----------
     number_pulse_trains : int
@@ -400,10 +637,12 @@ def send_stim_pulses_all_units(
     None
 
     """
+    next_train = time.monotonic()
     for _ in range(number_pulse_trains):
         print("Send pulse")
         seq.send()
-        time.sleep(10)
+        next_train += 10
+        time.sleep(max(0.0, next_train - time.monotonic()))
 
 
 def send_stim_pulses_units_sequentially(
@@ -415,6 +654,11 @@ def send_stim_pulses_units_sequentially(
     function `prepare_stim_sequence` for the case where there
     stimulation pulses are sent sequentially to one unit at a time.
 
+    Notes
+    -----
+    The power up and power down commands of every unit are built once
+    before the loop and sent as they are.
+
     Parameters
     ----------
     seq : mx.Sequence
@@ -428,16 +672,18 @@ def send_stim_pulses_units_sequentially(
     None
 
     """
-    for stim_unit in stim_units:
+    up_cmds = [powerup_stim_unit(stim_unit) for stim_unit in stim_units]
+    down_cmds = [
+        mx.StimulationUnit(stim_unit).power_up(False)
+        for stim_unit in stim_units
+    ]
+    for stim_unit, up_cmd, down_cmd in zip(stim_units, up_cmds, down_cmds):
         print(f"Power up stimulation unit {stim_unit}")
-        stim = mx.StimulationUnit(stim_unit)
-        stim.power_up(True).connect(True).set_voltage_mode().dac_source(0)
-        mx.send(stim)
+        mx.send(up_cmd)
         print("Send pulse")
         seq.send()
         print(f"Power down stimulation unit {stim_unit}")
-        stim = mx.StimulationUnit(stim_unit).power_up(False)
-        mx.send(stim)
+        mx.send(down_cmd)
         time.sleep(2)
 
 
@@ -506,7 +752,8 @@ if __name__ == "__main__":
         )
         send_stim_pulses_units_sequentially(seq, stim_units)
 
-    # If one wishes to send 2 sequences (pulse trains) randomly, run for example:
+    # If one wishes to send 2 sequences (pulse trains) randomly, run for example
+    # (the event ids of seq_2 continue after the last pulse of seq_1):
     #
     # seq_1 = prepare_stim_sequence(number_pulses_per_train, inter_pulse_interval, phase, amplitude=200)
     # seq_2 = prepare_stim_sequence(number_pulses_per_train, inter_pulse_interval, phase, amplitude=150)
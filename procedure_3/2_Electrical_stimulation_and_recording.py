@@ -16,16 +16,20 @@ import maxlab.util
 import os
 import time
 import pickle
+import numpy as np
 
 ## Define global parameters ##
-event_counter = (
-    1  # increment when a new pulse is generated, useful in the decoding part
-)
+first_event_id = 2  # event id of the first pulse, one more for every next pulse, useful in the decoding part
 audio_number = (
     240  # <-- number of audio clips, modify if using your own datasets
 )
 stim_amp_mV = 75  # stimulation amplitude in mV
 stim_amp_bits = int(stim_amp_mV / 2.92)  # convert stim amp to DAC bits
+sampling_rate = 20000  # samples per second
+phase_samples = 15  # duration of each phase of the biphasic pulse
+inter_pulse_samples = 1970  # delay after every pulse of a clip
+post_clip_samples = 22000  # first delay after the last pulse of a clip
+inter_clip_samples = 20000  # second delay, before the next clip starts
 
 with open(
     "./1_Japanese_Vowels_dataset/processed_dataset/selected_stimulation_electrode_indices.pkl",
@@ -35,6 +39,22 @@ with open(
         f
     )  # read the two-dimensional index list generated in the last section
 
+# Flatten the nested index lists once into a padded array (-1 marks padding)
+# and the number of indices of every pattern, shape (audio_number, 29)
+max_pattern_len = max(
+    len(pattern)
+    for indices_per_audioclip in stimulation_electrode_indices
+    for pattern in indices_per_audioclip
+)
+pattern_array = np.full(
+    (len(stimulation_electrode_indices), 29, max_pattern_len), -1, np.int8
+)
+pattern_lengths = np.zeros((len(stimulation_electrode_indices), 29), np.int8)
+for num, indices_per_audioclip in enumerate(stimulation_electrode_indices):
+    for timestep, pattern in enumerate(indices_per_audioclip):
+        pattern_array[num, timestep, : len(pattern)] = pattern
+        pattern_lengths[num, timestep] = len(pattern)
+
 name_of_configuration = "/home/mxwbio/configs/251008/25990_1008.cfg"  # <-- modify the path to your saved configuration
 stim_electrodes = [
     21672,
@@ -51,6 +71,13 @@ stim_electrodes = [
     18902,
 ]  # <-- modify the stimulation electrodes based on your own selection
 
+# Check the selection before talking to the server: at most 32 stimulation
+# units are available and every electrode can only be selected once
+if len(stim_electrodes) > 32:
+    raise ValueError("At most 32 stimulation electrodes can be selected.")
+if len(set(stim_electrodes)) != len(stim_electrodes):
+    raise ValueError("A stimulation electrode is selected twice.")
+
 
 ## 0. Initialize the system, enable stimulation power.
 maxlab.util.initialize()
@@ -64,6 +91,7 @@ array.select_stimulation_electrodes(stim_electrodes)
 
 ## 2. Connect stimulation electrodes to stimulation units.
 stimulation_units = []
+seen_units = set()  # stop at the first electrode sharing a stimulation unit
 
 for stim_el in stim_electrodes:
     array.connect_electrode_to_stimulation(stim_el)
@@ -73,75 +101,124 @@ for stim_el in stim_electrodes:
         raise RuntimeError(
             f"No stimulation channel can connect to electrode: {str(stim_el)}"
         )
+    if stim in seen_units:
+        raise RuntimeError(
+            "Multiple stimulation electrodes connected to same stimulation unit."
+        )
+    seen_units.add(stim)
     stimulation_units.append(stim)
-if len(set(stimulation_units)) != len(stimulation_units):
-    raise RuntimeError(
-        "Multiple stimulation electrodes connected to same stimulation unit."
-    )
 
 # Download the prepared array configuration to the chip
 array.download()
 
-
-## 3. Three Helper functions
-
-
-# 3.1 Prepare commands to power up and power down the two stimulation units
-def cmd_power_p(seq, pattern, stimulation_units):
+# The power up/down commands of a stimulation unit never change, build them
+# once per unit and reuse them at every timestep
+power_up_cmds = [
+    maxlab.chip.StimulationUnit(unit)
+    .power_up(True)
+    .connect(True)
+    .set_voltage_mode()
+    .dac_source(0)
+    for unit in stimulation_units
+]
+power_down_cmds = [
+    maxlab.chip.StimulationUnit(unit).power_up(False)
+    for unit in stimulation_units
+]
+
+
+## 3. Helper functions
+
+
+# 3.1 Append the commands to power up and power down the stimulation units,
+# `append` is the bound append method of the command list being built.
+# A unit that stays in the pattern of the next timestep is left powered up,
+# only the units leaving or entering the pattern are switched.
+def cmd_power_transition(append, active, pattern):
+    pattern_set = set(pattern)
+    for num in active:
+        if num not in pattern_set:
+            append(power_down_cmds[num])
     for num in pattern:
-        sti_power = (
-            maxlab.chip.StimulationUnit(stimulation_units[num])
-            .power_up(True)
-            .connect(True)
-            .set_voltage_mode()
-            .dac_source(0)
-        )
-        seq.append(sti_power)
+        if num not in active:
+            append(power_up_cmds[num])
+    return pattern_set
 
 
-def cmd_power_down_p(seq, pattern, stimulation_units):
+def cmd_power_down_p(append, pattern):
     for num in pattern:
-        sti_power_down = maxlab.chip.StimulationUnit(
-            stimulation_units[num]
-        ).power_up(False)
-        seq.append(sti_power_down)
-
-
-# 3.2 Prepare commands to append one pulse to an existing sequence
-def append_stimulation_pulse(seq, amplitude):
-    global event_counter
-    event_counter += 1
-    seq.append(
-        maxlab.Event(
-            0,
-            1,
-            event_counter,
-            f"amplitude{amplitude} event_id{event_counter}",
-        )
-    )
-    seq.append(maxlab.chip.DAC(0, 512 - amplitude))
-    seq.append(maxlab.system.DelaySamples(15))
-    seq.append(maxlab.chip.DAC(0, 512 + amplitude))
-    seq.append(maxlab.system.DelaySamples(15))
-    seq.append(maxlab.chip.DAC(0, 512))
+        append(power_down_cmds[num])
+
+
+# 3.2 Append the commands of one pulse
+# Only the event id changes from pulse to pulse, the DAC and delay commands
+# of the biphasic pulse are built once and reused
+Event = maxlab.Event
+dac_neg = maxlab.chip.DAC(0, 512 - stim_amp_bits)
+dac_pos = maxlab.chip.DAC(0, 512 + stim_amp_bits)
+dac_zero = maxlab.chip.DAC(0, 512)
+phase_delay = maxlab.system.DelaySamples(phase_samples)
+inter_pulse_delay = maxlab.system.DelaySamples(inter_pulse_samples)
+post_clip_delay = maxlab.system.DelaySamples(post_clip_samples)
+inter_clip_delay = maxlab.system.DelaySamples(inter_clip_samples)
+# Event labels of every pulse of the sequence, indexed by event id
+event_labels = [
+    f"amplitude{stim_amp_bits} event_id{event_id}"
+    for event_id in range(first_event_id + audio_number * 29)
+]
+
+
+def stimulation_pulse(append, event_id):
+    append(Event(0, 1, event_id, event_labels[event_id]))
+    append(dac_neg)
+    append(phase_delay)
+    append(dac_pos)
+    append(phase_delay)
+    append(dac_zero)
+
+
+# 3.3 Append a list of commands to an existing sequence
+def extend_sequence(seq, commands):
+    append = seq.append
+    for command in commands:
+        append(command)
     return seq
 
 
+# 3.4 Prepare the commands of one audio clip. The event ids of the clip
+# follow from its number, so every clip can be built on its own.
+def clip_commands(num):
+    # plain int lists of this clip, cheaper to index than the numpy array
+    patterns = pattern_array[num].tolist()
+    lengths = pattern_lengths[num].tolist()
+    clip_first_event_id = first_event_id + num * 29
+    commands = []
+    append = commands.append
+    active = set()  # units powered up at the current timestep
+    for timestep in range(0, 29):
+        pattern = patterns[timestep][: lengths[timestep]]
+        active = cmd_power_transition(append, active, pattern)
+        stimulation_pulse(append, clip_first_event_id + timestep)
+        append(inter_pulse_delay)
+    cmd_power_down_p(append, active)
+    append(post_clip_delay)
+    append(inter_clip_delay)
+    return commands
+
+
 ## 4. Construct stimulation command sequence from stimulation indices
+# The commands of one audio clip are collected in a plain list first and
+# appended to the sequence in one go
 sequence1 = maxlab.Sequence()
 for num in range(0, audio_number):
-    indices_per_audioclip = stimulation_electrode_indices[num]
-    for timestep in range(0, 29):
-        cmd_power_p(
-            sequence1, indices_per_audioclip[timestep], stimulation_units
-        )
-        append_stimulation_pulse(sequence1, stim_amp_bits)
-        cmd_power_down_p(
-            sequence1, indices_per_audioclip[timestep], stimulation_units
-        )
-        sequence1.append(maxlab.system.DelaySamples(1970))
-    sequence1.append(maxlab.system.DelaySamples(22000))
-    sequence1.append(maxlab.system.DelaySamples(20000))
+    extend_sequence(sequence1, clip_commands(num))
+# Playing time of the sequence, given by its delays
+sequence_samples = audio_number * (
+    29 * (2 * phase_samples + inter_pulse_samples)
+    + post_clip_samples
+    + inter_clip_samples
+)
+sequence_seconds = sequence_samples / sampling_rate
 
 ## 5. Start recording, offset the signal, send the command sequence, and stop recording.
 
@@ -166,6 +243,8 @@ time.sleep(10)
 sequence1.send()
 
 ### stop recording when all pulses are delivered ###
-time.sleep(240 * 5 + 10)
+# wait for the playing time of the sequence plus a few seconds of buffer,
+# counted from when send() returns so the upload does not shorten the wait
+time.sleep(sequence_seconds + 10)
 s.stop_recording()
 s.stop_file()